@@ -5,22 +5,31 @@ Automated setup of HA Kubernetes cluster from inventory file
 """
 
 import argparse
+import functools
+import hashlib
 import json
-import subprocess
+import os
+import re
+import shlex
 import sys
 import time
-import yaml
+import urllib.request
 from pathlib import Path
 from typing import List, Dict, Any
 import concurrent.futures
-import threading
 
-from inventory_parser import InventoryParser
+from inventory_parser import InventoryParser, load_yaml, dump_yaml_all
+from ssh_runner import SSHRunnerMixin
 
 
-class KubernetesBootstrap:
+class KubernetesBootstrap(SSHRunnerMixin):
     """Main class for Kubernetes cluster bootstrap"""
     
+    FLANNEL_MANIFEST_URL = "https://github.com/flannel-io/flannel/releases/download/v0.24.2/kube-flannel.yml"
+    LOCAL_PATH_MANIFEST_URL = "https://raw.githubusercontent.com/rancher/local-path-provisioner/v0.0.26/deploy/local-path-storage.yaml"
+    MANIFEST_CACHE_DIR = Path.home() / '.cache' / 'odp-k8s'
+    SSH_CIPHERS = "aes128-gcm@openssh.com,aes256-gcm@openssh.com,chacha20-poly1305@openssh.com,aes128-ctr,aes256-ctr"
+    
     def __init__(self, inventory_file: str, config_file: str = None):
         self.inventory_file = inventory_file
         self.config_file = config_file
@@ -28,8 +37,15 @@ class KubernetesBootstrap:
         self.nodes = self.inventory.get_all_nodes()
         self.control_plane_nodes = self.inventory.get_control_plane_nodes(3)
         self.worker_nodes = self.inventory.get_worker_nodes(3)
+        # kubectl (run_kubectl) talks to the first control plane node
+        self.master_info = self.control_plane_nodes[0] if self.control_plane_nodes else None
         self.cluster_config = self._load_cluster_config()
-        self.lock = threading.Lock()
+        
+        # SSH multiplexing, resolved client binaries and local node detection
+        self._init_runner()
+        
+        # One worker pool shared by every parallel phase; threads are started lazily
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers(self.nodes))
         
     def _load_cluster_config(self) -> Dict[str, Any]:
         """Load cluster configuration"""
@@ -40,7 +56,13 @@ class KubernetesBootstrap:
             'container_runtime': 'containerd',
             'cni_plugin': 'flannel',
             'storage_class': 'local-path',
+            'flannel_manifest_url': self.FLANNEL_MANIFEST_URL,
+            'local_path_manifest_url': self.LOCAL_PATH_MANIFEST_URL,
+            'flannel_manifest_sha256': None,
+            'local_path_manifest_sha256': None,
             'timezone': 'UTC',
+            'ssh_parallelism': 32,
+            'ssh_compression': False,
             'ntp_servers': ['pool.ntp.org', 'time.google.com'],
             'firewall_rules': {
                 'control_plane_ports': [6443, 2379, 2380, 10250, 10251, 10252, 10259, 10257],
@@ -51,51 +73,63 @@ class KubernetesBootstrap:
         
         if self.config_file and Path(self.config_file).exists():
             with open(self.config_file, 'r') as f:
-                user_config = yaml.safe_load(f)
+                user_config = load_yaml(f)
                 default_config.update(user_config)
         
         return default_config
     
-    def run_ssh_command(self, host: Dict[str, Any], command: str, timeout: int = 300) -> tuple:
-        """Run SSH command on remote host"""
-        ssh_cmd = [
-            'ssh', '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-o', 'ConnectTimeout=10',
-            '-p', str(host['ssh_port']),
-            f"{host['username']}@{host['ip_address']}",
-            command
-        ]
-        
-        try:
-            result = subprocess.run(
-                ssh_cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=timeout
-            )
-            return result.returncode, result.stdout, result.stderr
-        except subprocess.TimeoutExpired:
-            return -1, "", "Command timed out"
-        except Exception as e:
-            return -1, "", str(e)
+    def _max_workers(self, hosts: List[Dict[str, Any]]) -> int:
+        """Size a thread pool to the host count, capped by ssh_parallelism"""
+        return max(1, min(len(hosts), self.cluster_config.get('ssh_parallelism', 32)))
     
-    def copy_file_to_host(self, host: Dict[str, Any], local_file: str, remote_path: str) -> bool:
-        """Copy file to remote host using scp"""
-        scp_cmd = [
-            'scp', '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-P', str(host['ssh_port']),
-            local_file,
-            f"{host['username']}@{host['ip_address']}:{remote_path}"
-        ]
+    def _extra_ssh_options(self, host: Dict[str, Any]) -> List[str]:
+        """Cipher and compression choices from the cluster config"""
+        # Prefer AES-GCM (AES-NI accelerated), keep the others as fallback
+        options = ['-o', f"Ciphers={self.SSH_CIPHERS}"]
         
-        try:
-            result = subprocess.run(scp_cmd, capture_output=True, text=True)
-            return result.returncode == 0
-        except Exception as e:
-            print(f"Error copying file to {host['hostname']}: {e}")
+        # Compression only pays off on slow links
+        if self.cluster_config.get('ssh_compression'):
+            options += ['-o', 'Compression=yes']
+        
+        return options
+    
+    def open_masters(self) -> bool:
+        """Open the persistent SSH connection to every node up front"""
+        print("Opening SSH connections...")
+        return self._run_on_hosts(self._check_connection, self.nodes, "connect to")
+    
+    def _check_connection(self, host: Dict[str, Any]) -> bool:
+        """Establish the master connection to a single node"""
+        returncode, stdout, stderr = self.run_ssh_command(host, 'true', timeout=30)
+        if returncode != 0:
+            print(f"Failed to connect to {host['hostname']}: {stderr}")
             return False
+        return True
+    
+    def _run_on_hosts(self, func, hosts: List[Dict[str, Any]], action: str) -> bool:
+        """Run func(host) for every host on the shared worker pool"""
+        future_to_host = {self._executor.submit(func, host): host for host in hosts}
+        
+        results = []
+        for future in concurrent.futures.as_completed(future_to_host):
+            host = future_to_host[future]
+            try:
+                success = future.result()
+                results.append(success)
+                if not success:
+                    print(f"Failed to {action} {host['hostname']}")
+            except Exception as e:
+                print(f"Exception trying to {action} {host['hostname']}: {e}")
+                results.append(False)
+        
+        return all(results)
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _prepare_command(os_name: str, os_version: str, timezone: str) -> str:
+        """Build the quoted prepare_node.sh command line, shared by identical hosts"""
+        args = ['--os', os_name, '--version', os_version, '--timezone', timezone]
+        return f"chmod +x /tmp/prepare_node.sh && /tmp/prepare_node.sh {shlex.join(args)}"
     
     def prepare_node(self, host: Dict[str, Any]) -> bool:
         """Prepare a single node for Kubernetes"""
@@ -106,17 +140,15 @@ class KubernetesBootstrap:
             print(f"Failed to copy preparation script to {host['hostname']}")
             return False
         
-        # Make script executable and run it
-        commands = [
-            'chmod +x /tmp/prepare_node.sh',
-            f'/tmp/prepare_node.sh --os {host["os"]} --version {host["os_version"]} --timezone {self.cluster_config["timezone"]}'
-        ]
+        # Make script executable and run it in a single SSH session
+        cmd = self._prepare_command(
+            str(host['os']), str(host['os_version']), str(self.cluster_config['timezone'])
+        )
         
-        for cmd in commands:
-            returncode, stdout, stderr = self.run_ssh_command(host, cmd, timeout=600)
-            if returncode != 0:
-                print(f"Error on {host['hostname']}: {stderr}")
-                return False
+        returncode, stdout, stderr = self.run_ssh_command(host, cmd, timeout=600)
+        if returncode != 0:
+            print(f"Error on {host['hostname']}: {stderr}")
+            return False
         
         print(f"Successfully prepared node: {host['hostname']}")
         return True
@@ -124,26 +156,7 @@ class KubernetesBootstrap:
     def prepare_all_nodes(self) -> bool:
         """Prepare all nodes in parallel"""
         print("Preparing all nodes...")
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_host = {
-                executor.submit(self.prepare_node, host): host 
-                for host in self.nodes
-            }
-            
-            results = []
-            for future in concurrent.futures.as_completed(future_to_host):
-                host = future_to_host[future]
-                try:
-                    success = future.result()
-                    results.append(success)
-                    if not success:
-                        print(f"Failed to prepare {host['hostname']}")
-                except Exception as e:
-                    print(f"Exception preparing {host['hostname']}: {e}")
-                    results.append(False)
-        
-        return all(results)
+        return self._run_on_hosts(self.prepare_node, self.nodes, "prepare")
     
     def initialize_control_plane(self) -> bool:
         """Initialize the first control plane node"""
@@ -153,17 +166,16 @@ class KubernetesBootstrap:
         # Generate kubeadm config
         kubeadm_config = self._generate_kubeadm_config()
         
-        # Copy config to master node
-        config_file = '/tmp/kubeadm-config.yaml'
-        with open(config_file, 'w') as f:
-            yaml.dump(kubeadm_config, f)
-        
-        if not self.copy_file_to_host(master_node, config_file, '/tmp/kubeadm-config.yaml'):
-            return False
+        config_yaml = dump_yaml_all(kubeadm_config)
         
-        # Initialize cluster
-        init_cmd = 'kubeadm init --config=/tmp/kubeadm-config.yaml --upload-certs'
-        returncode, stdout, stderr = self.run_ssh_command(master_node, init_cmd, timeout=900)
+        # Stream config to the master node and initialize cluster in one SSH session
+        init_cmd = (
+            'cat > /tmp/kubeadm-config.yaml && '
+            'kubeadm init --config=/tmp/kubeadm-config.yaml --upload-certs'
+        )
+        returncode, stdout, stderr = self.run_ssh_command(
+            master_node, init_cmd, timeout=900, stdin=config_yaml
+        )
         
         if returncode != 0:
             print(f"Failed to initialize control plane: {stderr}")
@@ -175,8 +187,8 @@ class KubernetesBootstrap:
         print(f"Successfully initialized control plane on {master_node['hostname']}")
         return True
     
-    def _generate_kubeadm_config(self) -> Dict[str, Any]:
-        """Generate kubeadm configuration"""
+    def _generate_kubeadm_config(self) -> List[Dict[str, Any]]:
+        """Generate kubeadm configuration (InitConfiguration and ClusterConfiguration documents)"""
         config = {
             'apiVersion': 'kubeadm.k8s.io/v1beta3',
             'kind': 'InitConfiguration',
@@ -207,11 +219,12 @@ class KubernetesBootstrap:
             }
         }
         
-        return {**config, **cluster_config}
+        return [config, cluster_config]
     
     def _extract_join_commands(self, init_output: str):
         """Extract join commands from kubeadm init output"""
-        lines = init_output.split('\n')
+        # kubeadm wraps join commands over several lines ending in '\'
+        lines = re.sub(r'\\\s*\n\s*', ' ', init_output).split('\n')
         self.control_plane_join_cmd = None
         self.worker_join_cmd = None
         
@@ -222,55 +235,55 @@ class KubernetesBootstrap:
                 self.worker_join_cmd = line.strip()
     
     def join_control_plane_nodes(self) -> bool:
-        """Join remaining control plane nodes"""
+        """Join remaining control plane nodes one at a time"""
         if len(self.control_plane_nodes) <= 1:
             return True
         
         print("Joining additional control plane nodes...")
         
-        for node in self.control_plane_nodes[1:]:
-            print(f"Joining control plane node: {node['hostname']}")
-            
-            returncode, stdout, stderr = self.run_ssh_command(
-                node, 
-                self.control_plane_join_cmd, 
-                timeout=600
-            )
-            
-            if returncode != 0:
-                print(f"Failed to join control plane node {node['hostname']}: {stderr}")
+        # Each join adds an etcd member and a join takes minutes, so starting
+        # them a few seconds apart would still race; join strictly in order
+        for host in self.control_plane_nodes[1:]:
+            if not self._join_control_plane_node(host):
                 return False
-            
-            print(f"Successfully joined control plane node: {node['hostname']}")
         
         return True
     
+    def _join_control_plane_node(self, host: Dict[str, Any]) -> bool:
+        """Join a single control plane node"""
+        print(f"Joining control plane node: {host['hostname']}")
+        
+        returncode, stdout, stderr = self.run_ssh_command(
+            host, 
+            self.control_plane_join_cmd, 
+            timeout=600
+        )
+        
+        if returncode != 0:
+            print(f"Failed to join control plane node {host['hostname']}: {stderr}")
+            return False
+        
+        print(f"Successfully joined control plane node: {host['hostname']}")
+        return True
+    
     def join_worker_nodes(self) -> bool:
         """Join worker nodes"""
         if not self.worker_nodes:
             return True
         
         print("Joining worker nodes...")
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            future_to_host = {
-                executor.submit(self._join_worker_node, host): host 
-                for host in self.worker_nodes
-            }
-            
-            results = []
-            for future in concurrent.futures.as_completed(future_to_host):
-                host = future_to_host[future]
-                try:
-                    success = future.result()
-                    results.append(success)
-                    if not success:
-                        print(f"Failed to join worker node {host['hostname']}")
-                except Exception as e:
-                    print(f"Exception joining worker node {host['hostname']}: {e}")
-                    results.append(False)
-        
-        return all(results)
+        return self._run_on_hosts(self._join_worker_node, self.worker_nodes, "join worker node")
+    
+    def join_nodes(self) -> bool:
+        """Join remaining control plane nodes and worker nodes concurrently"""
+        print("Joining control plane and worker nodes...")
+        
+        # Workers only need the first API server, so they don't wait for the
+        # other control plane nodes; those still join one at a time on a
+        # single pool thread
+        control_plane_joined = self._executor.submit(self.join_control_plane_nodes)
+        workers_joined = self.join_worker_nodes()
+        return control_plane_joined.result() and workers_joined
     
     def _join_worker_node(self, host: Dict[str, Any]) -> bool:
         """Join a single worker node"""
@@ -289,44 +302,63 @@ class KubernetesBootstrap:
         print(f"Successfully joined worker node: {host['hostname']}")
         return True
     
-    def setup_networking(self) -> bool:
-        """Setup CNI networking"""
-        master_node = self.control_plane_nodes[0]
-        print("Setting up CNI networking...")
-        
-        # Install Flannel
-        flannel_cmd = f"kubectl apply -f https://raw.githubusercontent.com/flannel-io/flannel/master/Documentation/kube-flannel.yml"
-        returncode, stdout, stderr = self.run_ssh_command(master_node, flannel_cmd)
-        
-        if returncode != 0:
-            print(f"Failed to install Flannel: {stderr}")
-            return False
-        
-        print("Successfully installed Flannel CNI")
-        return True
+    def _fetch_manifest(self, url: str, sha256: str = None) -> str:
+        """Download a manifest once and serve it from the local cache afterwards
+        
+        The cache is keyed by URL, so only immutable (release) URLs should be
+        used. With a sha256 digest, a cached copy that no longer matches is
+        downloaded again and a download that doesn't match is rejected.
+        """
+        cache_file = self.MANIFEST_CACHE_DIR / f"{hashlib.sha256(url.encode()).hexdigest()}.yaml"
+        if cache_file.exists():
+            content = cache_file.read_text()
+            if not sha256 or hashlib.sha256(content.encode()).hexdigest() == sha256.lower():
+                return content
+        
+        with urllib.request.urlopen(url, timeout=60) as response:
+            content = response.read().decode()
+        
+        if sha256:
+            digest = hashlib.sha256(content.encode()).hexdigest()
+            if digest != sha256.lower():
+                raise ValueError(f"Checksum mismatch for {url}: expected {sha256}, got {digest}")
+        
+        # Write atomically so an interrupted download never poisons the cache
+        self.MANIFEST_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        tmp_file.write_text(content)
+        tmp_file.replace(cache_file)
+        
+        return content
     
-    def setup_storage(self) -> bool:
-        """Setup local-path storage class"""
+    def setup_cluster_addons(self) -> bool:
+        """Setup CNI networking and local-path storage class in one SSH session"""
         master_node = self.control_plane_nodes[0]
-        print("Setting up local-path storage...")
-        
-        # Install local-path-provisioner
-        storage_cmd = "kubectl apply -f https://raw.githubusercontent.com/rancher/local-path-provisioner/master/deploy/local-path-storage.yaml"
-        returncode, stdout, stderr = self.run_ssh_command(master_node, storage_cmd)
+        print("Setting up CNI networking and local-path storage...")
         
-        if returncode != 0:
-            print(f"Failed to install local-path storage: {stderr}")
+        try:
+            manifests = "\n---\n".join([
+                self._fetch_manifest(self.cluster_config['flannel_manifest_url'],
+                                     self.cluster_config.get('flannel_manifest_sha256')),
+                self._fetch_manifest(self.cluster_config['local_path_manifest_url'],
+                                     self.cluster_config.get('local_path_manifest_sha256'))
+            ])
+        except Exception as e:
+            print(f"Failed to fetch addon manifests: {e}")
             return False
         
-        # Set as default storage class
-        default_cmd = "kubectl patch storageclass local-path -p '{\"metadata\": {\"annotations\":{\"storageclass.kubernetes.io/is-default-class\":\"true\"}}}'"
-        returncode, stdout, stderr = self.run_ssh_command(master_node, default_cmd)
+        # Install Flannel and local-path-provisioner, then make local-path the default
+        addons_cmd = " && ".join([
+            "kubectl apply -f -",
+            "kubectl patch storageclass local-path -p '{\"metadata\": {\"annotations\":{\"storageclass.kubernetes.io/is-default-class\":\"true\"}}}'"
+        ])
+        returncode, stdout, stderr = self.run_ssh_command(master_node, addons_cmd, stdin=manifests)
         
         if returncode != 0:
-            print(f"Failed to set default storage class: {stderr}")
+            print(f"Failed to setup cluster addons: {stderr}")
             return False
         
-        print("Successfully setup local-path storage")
+        print("Successfully installed Flannel CNI and local-path storage")
         return True
     
     def verify_cluster(self) -> bool:
@@ -334,27 +366,25 @@ class KubernetesBootstrap:
         master_node = self.control_plane_nodes[0]
         print("Verifying cluster...")
         
-        # Check node status
-        nodes_cmd = "kubectl get nodes -o wide"
-        returncode, stdout, stderr = self.run_ssh_command(master_node, nodes_cmd)
+        # Check node and pod status in one SSH session
+        separator = '---PODSPLIT---'
+        verify_cmd = (
+            f"kubectl get nodes -o wide && echo '{separator}' && "
+            "kubectl get pods --all-namespaces"
+        )
+        returncode, stdout, stderr = self.run_ssh_command(master_node, verify_cmd)
         
-        if returncode != 0:
-            print(f"Failed to get nodes: {stderr}")
+        if returncode != 0 or separator not in stdout:
+            print(f"Failed to get cluster status: {stderr}")
             return False
         
-        print("Cluster nodes:")
-        print(stdout)
-        
-        # Check pod status
-        pods_cmd = "kubectl get pods --all-namespaces"
-        returncode, stdout, stderr = self.run_ssh_command(master_node, pods_cmd)
+        nodes_output, pods_output = stdout.split(separator, 1)
         
-        if returncode != 0:
-            print(f"Failed to get pods: {stderr}")
-            return False
+        print("Cluster nodes:")
+        print(nodes_output.strip())
         
         print("Cluster pods:")
-        print(stdout)
+        print(pods_output.strip())
         
         return True
     
@@ -365,20 +395,23 @@ class KubernetesBootstrap:
         print(f"Worker nodes: {len(self.worker_nodes)}")
         
         steps = [
+            ("Opening SSH connections", self.open_masters),
             ("Preparing all nodes", self.prepare_all_nodes),
             ("Initializing control plane", self.initialize_control_plane),
-            ("Joining control plane nodes", self.join_control_plane_nodes),
-            ("Joining worker nodes", self.join_worker_nodes),
-            ("Setting up networking", self.setup_networking),
-            ("Setting up storage", self.setup_storage),
+            ("Joining control plane and worker nodes", self.join_nodes),
+            ("Setting up networking and storage", self.setup_cluster_addons),
             ("Verifying cluster", self.verify_cluster)
         ]
         
-        for step_name, step_func in steps:
-            print(f"\n--- {step_name} ---")
-            if not step_func():
-                print(f"Bootstrap failed at: {step_name}")
-                return False
+        try:
+            for step_name, step_func in steps:
+                print(f"\n--- {step_name} ---")
+                if not step_func():
+                    print(f"Bootstrap failed at: {step_name}")
+                    return False
+        finally:
+            self._executor.shutdown()
+            self.close_master()
         
         print("\n🎉 Kubernetes cluster bootstrap completed successfully!")
         print(f"Cluster has {len(self.control_plane_nodes)} control plane nodes and {len(self.worker_nodes)} worker nodes")
@@ -404,6 +437,7 @@ def main():
             print(f"Worker nodes: {len(bootstrap.worker_nodes)}")
             print(f"Kubernetes version: {bootstrap.cluster_config['kubernetes_version']}")
             print(f"Pod network CIDR: {bootstrap.cluster_config['pod_network_cidr']}")
+            bootstrap.close_master()
             return
         
         success = bootstrap.bootstrap_cluster()
@@ -4,25 +4,79 @@ Host Inventory Parser for Kubernetes Cluster Bootstrap
 Supports YAML, INI, and CSV formats
 """
 
-import yaml
-import configparser
-import csv
+import functools
 import json
 import argparse
+import os
 import sys
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
+
+
+@functools.lru_cache(maxsize=None)
+def _yaml_module():
+    """Import PyYAML on first use"""
+    import yaml
+    return yaml
+
+
+def load_yaml(stream) -> Any:
+    """Safe-load YAML, using the libyaml-backed loader when available"""
+    yaml = _yaml_module()
+    return yaml.load(stream, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def dump_yaml(data: Any, stream=None, **kwargs) -> Any:
+    """Safe-dump YAML, using the libyaml-backed dumper when available"""
+    yaml = _yaml_module()
+    return yaml.dump(data, stream, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), **kwargs)
+
+
+def dump_yaml_all(documents: List[Any], stream=None, **kwargs) -> Any:
+    """Safe-dump several YAML documents separated by '---'"""
+    yaml = _yaml_module()
+    return yaml.dump_all(documents, stream, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), **kwargs)
 
 
 class InventoryParser:
     """Parse host inventory files in multiple formats"""
     
+    DEFAULT_HOST = {
+        'hostname': '',
+        'ip_address': '',
+        'username': 'root',
+        'ssh_port': 22,
+        'role': 'worker',
+        'group': 'default',
+        'os': 'ubuntu',
+        'os_version': '22.04'
+    }
+    
+    # Standard key -> accepted aliases, in order of precedence
+    KEY_MAPPINGS = {
+        'hostname': ['hostname', 'host', 'name', 'fqdn'],
+        'ip_address': ['ip_address', 'ip', 'address'],
+        'username': ['username', 'user', 'login'],
+        'ssh_port': ['ssh_port', 'port'],
+        'role': ['role', 'type', 'node_type'],
+        'group': ['group', 'cluster'],
+        'os': ['os', 'operating_system'],
+        'os_version': ['os_version', 'version']
+    }
+    
+    # Alias -> (standard key, precedence), inverted once at class creation
+    _REVERSE_KEY_MAP = {
+        alias: (standard_key, rank)
+        for standard_key, aliases in KEY_MAPPINGS.items()
+        for rank, alias in enumerate(aliases)
+    }
+    
     def __init__(self, inventory_file: str):
         self.inventory_file = Path(inventory_file)
-        self.hosts = []
         
-    def parse(self) -> List[Dict[str, Any]]:
-        """Parse inventory file based on extension"""
+    @functools.cached_property
+    def nodes(self) -> List[Dict[str, Any]]:
+        """Hosts parsed from the inventory file, read once per parser"""
         if not self.inventory_file.exists():
             raise FileNotFoundError(f"Inventory file not found: {self.inventory_file}")
             
@@ -37,10 +91,14 @@ class InventoryParser:
         else:
             raise ValueError(f"Unsupported file format: {extension}")
     
+    def parse(self) -> List[Dict[str, Any]]:
+        """Return the parsed hosts; the file itself is only read once, see nodes"""
+        return self.nodes
+    
     def _parse_yaml(self) -> List[Dict[str, Any]]:
         """Parse YAML inventory file"""
         with open(self.inventory_file, 'r') as f:
-            data = yaml.safe_load(f)
+            data = load_yaml(f)
         
         hosts = []
         
@@ -69,6 +127,8 @@ class InventoryParser:
     
     def _parse_ini(self) -> List[Dict[str, Any]]:
         """Parse INI inventory file"""
+        import configparser
+        
         config = configparser.ConfigParser()
         config.read(self.inventory_file)
         
@@ -97,46 +157,54 @@ class InventoryParser:
     
     def _parse_csv(self) -> List[Dict[str, Any]]:
         """Parse CSV inventory file"""
+        import csv
+        
         hosts = []
         
         with open(self.inventory_file, 'r') as f:
-            reader = csv.DictReader(f)
+            reader = csv.reader(f)
+            header = next(reader, [])
+            
+            # Resolve which column feeds each standard key once for the whole file
+            columns = {}
+            for index, name in enumerate(header):
+                mapping = self._REVERSE_KEY_MAP.get(name)
+                if mapping is None:
+                    continue
+                standard_key, rank = mapping
+                if standard_key not in columns or rank < columns[standard_key][1]:
+                    columns[standard_key] = (index, rank)
+            column_index = [(key, index) for key, (index, _) in columns.items()]
+            
             for row in reader:
-                hosts.append(self._normalize_host(row))
+                if not row:
+                    continue
+                host = self.DEFAULT_HOST.copy()
+                for key, index in column_index:
+                    host[key] = row[index] if index < len(row) else None
+                hosts.append(self._finalize_host(host))
         
         return hosts
     
     def _normalize_host(self, host_data: Dict[str, Any]) -> Dict[str, Any]:
         """Normalize host data to standard format"""
-        normalized = {
-            'hostname': '',
-            'ip_address': '',
-            'username': 'root',
-            'ssh_port': 22,
-            'role': 'worker',
-            'group': 'default',
-            'os': 'ubuntu',
-            'os_version': '22.04'
-        }
-        
-        # Map various possible keys to standard format
-        key_mappings = {
-            'hostname': ['hostname', 'host', 'name', 'fqdn'],
-            'ip_address': ['ip_address', 'ip', 'address'],
-            'username': ['username', 'user', 'login'],
-            'ssh_port': ['ssh_port', 'port'],
-            'role': ['role', 'type', 'node_type'],
-            'group': ['group', 'cluster'],
-            'os': ['os', 'operating_system'],
-            'os_version': ['os_version', 'version']
-        }
-        
-        for standard_key, possible_keys in key_mappings.items():
-            for key in possible_keys:
-                if key in host_data:
-                    normalized[standard_key] = host_data[key]
-                    break
+        normalized = self.DEFAULT_HOST.copy()
+        
+        # Map various possible keys to standard format, earlier aliases win
+        ranks = {}
+        for key, value in host_data.items():
+            mapping = self._REVERSE_KEY_MAP.get(key)
+            if mapping is None:
+                continue
+            standard_key, rank = mapping
+            if rank < ranks.get(standard_key, len(self.KEY_MAPPINGS[standard_key])):
+                normalized[standard_key] = value
+                ranks[standard_key] = rank
         
+        return self._finalize_host(normalized)
+    
+    def _finalize_host(self, normalized: Dict[str, Any]) -> Dict[str, Any]:
+        """Validate a normalized host and fill in derived fields"""
         # Ensure we have either hostname or IP
         if not normalized['hostname'] and not normalized['ip_address']:
             raise ValueError("Host must have either hostname or IP address")
@@ -149,38 +217,39 @@ class InventoryParser:
     
     def get_control_plane_nodes(self, count: int = 3) -> List[Dict[str, Any]]:
         """Get first N nodes as control plane nodes"""
-        hosts = self.parse()
-        control_plane = hosts[:count]
-        
-        # Update roles
-        for host in control_plane:
-            host['role'] = 'control-plane'
-        
-        return control_plane
+        # Copies, so role assignment never touches the cached hosts
+        return [dict(host, role='control-plane') for host in self.nodes[:count]]
     
     def get_worker_nodes(self, skip_first: int = 3) -> List[Dict[str, Any]]:
         """Get remaining nodes as worker nodes"""
-        hosts = self.parse()
-        workers = hosts[skip_first:]
-        
-        # Ensure all are marked as workers
-        for host in workers:
-            host['role'] = 'worker'
-        
-        return workers
+        return [dict(host, role='worker') for host in self.nodes[skip_first:]]
     
     def get_all_nodes(self) -> List[Dict[str, Any]]:
         """Get all nodes with proper role assignment"""
-        hosts = self.parse()
-        
         # Assign roles: first 3 as control-plane, rest as workers
-        for i, host in enumerate(hosts):
-            if i < 3:
-                host['role'] = 'control-plane'
-            else:
-                host['role'] = 'worker'
-        
-        return hosts
+        return [
+            dict(host, role='control-plane' if i < 3 else 'worker')
+            for i, host in enumerate(self.nodes)
+        ]
+
+
+@functools.lru_cache(maxsize=8)
+def _load_inventory(path: str, mtime_ns: int) -> Tuple[InventoryParser, List[Dict[str, Any]]]:
+    """Parse an inventory once per (path, modification time)"""
+    inventory = InventoryParser(path)
+    return inventory, inventory.get_all_nodes()
+
+
+def load_inventory(inventory_file: str) -> Tuple[InventoryParser, List[Dict[str, Any]]]:
+    """Return the parser and role-assigned nodes, reusing earlier parses in this process"""
+    path = os.path.abspath(inventory_file)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Inventory file not found: {inventory_file}") from None
+    
+    inventory, nodes = _load_inventory(path, mtime_ns)
+    return inventory, list(nodes)
 
 
 def main():
@@ -203,7 +272,7 @@ def main():
         if args.output == 'json':
             print(json.dumps(nodes, indent=2))
         else:
-            print(yaml.dump(nodes, default_flow_style=False))
+            print(dump_yaml(nodes, default_flow_style=False))
             
     except Exception as e:
         print(f"Error: {e}", file=sys.stderr)
@@ -5,7 +5,8 @@ Adds a new node to an existing Kubernetes cluster
 """
 
 import argparse
-import subprocess
+import concurrent.futures
+import shlex
 import sys
 import time
 import yaml
@@ -13,184 +14,184 @@ from pathlib import Path
 from typing import Dict, Any, List
 import json
 
-from inventory_parser import InventoryParser
+from inventory_parser import load_inventory
+from ssh_runner import SSHRunnerMixin
 
 
-class NodeAdder:
+class NodeAdder(SSHRunnerMixin):
     """Class for adding nodes to Kubernetes cluster"""
     
+    # Reuse generated join commands well within the 24h token lifetime
+    # (and the 2h lifetime of uploaded control plane certificates)
+    JOIN_CACHE_TTL = 3600
+    
+    # Seconds between node readiness checks
+    NODE_POLL_INTERVAL = 5
+    
+    # Abort a batch once at least this many nodes have finished and more
+    # than this fraction of them failed; the cause is likely shared
+    ABORT_MIN_COMPLETED = 5
+    ABORT_FAILURE_RATIO = 0.5
+    
     def __init__(self, inventory_file: str, master_node: str):
         self.inventory_file = inventory_file
         self.master_node = master_node
-        self.inventory = InventoryParser(inventory_file)
-        self.nodes = self.inventory.get_all_nodes()
+        # Parsed once per process; a rolling replace builds both a remover
+        # and an adder from the same inventory
+        self.inventory, self.nodes = load_inventory(inventory_file)
+        
+        # Index nodes by hostname and IP; the first entry wins on duplicates
+        self._by_host = {node['hostname']: node for node in reversed(self.nodes)}
+        self._by_ip = {node['ip_address']: node for node in reversed(self.nodes)}
         
         # Find master node info
-        self.master_info = None
-        for node in self.nodes:
-            if node['hostname'] == master_node or node['ip_address'] == master_node:
-                self.master_info = node
-                break
+        self.master_info = self.find_node(master_node)
         
         if not self.master_info:
             raise ValueError(f"Master node not found: {master_node}")
+        
+        # SSH multiplexing, local fast path, kubectl and node list cache
+        self._init_runner()
+        self._join_cache = {}
     
-    def run_ssh_command(self, host: Dict[str, Any], command: str, timeout: int = 300) -> tuple:
-        """Run SSH command on remote host"""
-        ssh_cmd = [
-            'ssh', '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-o', 'ConnectTimeout=10',
-            '-p', str(host['ssh_port']),
-            f"{host['username']}@{host['ip_address']}",
-            command
-        ]
-        
-        try:
-            result = subprocess.run(
-                ssh_cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=timeout
-            )
-            return result.returncode, result.stdout, result.stderr
-        except subprocess.TimeoutExpired:
-            return -1, "", "Command timed out"
-        except Exception as e:
-            return -1, "", str(e)
-    
-    def copy_file_to_host(self, host: Dict[str, Any], local_file: str, remote_path: str) -> bool:
-        """Copy file to remote host using scp"""
-        scp_cmd = [
-            'scp', '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-P', str(host['ssh_port']),
-            local_file,
-            f"{host['username']}@{host['ip_address']}:{remote_path}"
-        ]
-        
-        try:
-            result = subprocess.run(scp_cmd, capture_output=True, text=True)
-            return result.returncode == 0
-        except Exception as e:
-            print(f"Error copying file to {host['hostname']}: {e}")
-            return False
+    def find_node(self, node_identifier: str) -> Dict[str, Any]:
+        """Find an inventory node by hostname or IP address"""
+        return self._by_host.get(node_identifier) or self._by_ip.get(node_identifier)
     
-    def get_join_token(self) -> str:
-        """Get join token from master node"""
-        print("Getting join token from master node...")
+    def _get_cached_join_command(self, kind: str, cmd: str) -> str:
+        """Run a join command generator on the master, reusing a recent result"""
+        cached = self._join_cache.get(kind)
+        if cached and time.monotonic() - cached[1] < self.JOIN_CACHE_TTL:
+            return cached[0]
         
-        # Get control plane join command
-        cmd = "kubeadm token create --print-join-command"
         returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
         
         if returncode != 0:
-            print(f"Failed to get join token: {stderr}")
+            self._log(f"Failed to get {kind} join command: {stderr}")
             return None
         
-        return stdout.strip()
+        join_command = stdout.strip()
+        self._join_cache[kind] = (join_command, time.monotonic())
+        return join_command
+    
+    def get_join_token(self) -> str:
+        """Get join token from master node"""
+        self._log("Getting join token from master node...")
+        return self._get_cached_join_command('worker', "kubeadm token create --print-join-command")
     
     def get_control_plane_join_command(self) -> str:
         """Get control plane join command"""
-        print("Getting control plane join command...")
+        self._log("Getting control plane join command...")
         
         # Get control plane join command with certificate key
         cmd = "kubeadm init phase upload-certs --upload-certs --print-join-command"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
-        
-        if returncode != 0:
-            print(f"Failed to get control plane join command: {stderr}")
-            return None
-        
-        return stdout.strip()
+        return self._get_cached_join_command('control-plane', cmd)
     
     def prepare_new_node(self, node_info: Dict[str, Any]) -> bool:
         """Prepare a new node for joining the cluster"""
-        print(f"Preparing new node: {node_info['hostname']}")
+        self._log(f"Preparing new node: {node_info['hostname']}")
         
         # Copy node preparation script
         script_path = Path(__file__).parent / 'prepare_node.sh'
         if not self.copy_file_to_host(node_info, str(script_path), '/tmp/prepare_node.sh'):
-            print(f"Failed to copy preparation script to {node_info['hostname']}")
+            self._log(f"Failed to copy preparation script to {node_info['hostname']}")
             return False
         
-        # Make script executable and run it
-        commands = [
-            'chmod +x /tmp/prepare_node.sh',
-            f'/tmp/prepare_node.sh --os {node_info["os"]} --version {node_info["os_version"]}'
-        ]
+        # Make script executable and run it in a single SSH session
+        args = ['--os', str(node_info['os']), '--version', str(node_info['os_version'])]
+        cmd = f"chmod +x /tmp/prepare_node.sh && /tmp/prepare_node.sh {shlex.join(args)}"
         
-        for cmd in commands:
-            returncode, stdout, stderr = self.run_ssh_command(node_info, cmd, timeout=600)
-            if returncode != 0:
-                print(f"Error on {node_info['hostname']}: {stderr}")
-                return False
+        returncode, stdout, stderr = self.run_ssh_command(node_info, cmd, timeout=600, stream=True)
+        if returncode != 0:
+            self._log(f"Error on {node_info['hostname']}: {stderr}")
+            return False
         
-        print(f"Successfully prepared node: {node_info['hostname']}")
+        self._log(f"Successfully prepared node: {node_info['hostname']}")
         return True
     
     def join_worker_node(self, node_info: Dict[str, Any], join_command: str) -> bool:
         """Join a worker node to the cluster"""
-        print(f"Joining worker node: {node_info['hostname']}")
+        self._log(f"Joining worker node: {node_info['hostname']}")
         
         returncode, stdout, stderr = self.run_ssh_command(node_info, join_command, timeout=600)
         
         if returncode != 0:
-            print(f"Failed to join worker node {node_info['hostname']}: {stderr}")
+            self._log(f"Failed to join worker node {node_info['hostname']}: {stderr}")
             return False
         
-        print(f"Successfully joined worker node: {node_info['hostname']}")
+        self._log(f"Successfully joined worker node: {node_info['hostname']}")
         return True
     
     def join_control_plane_node(self, node_info: Dict[str, Any], join_command: str) -> bool:
         """Join a control plane node to the cluster"""
-        print(f"Joining control plane node: {node_info['hostname']}")
+        self._log(f"Joining control plane node: {node_info['hostname']}")
         
         returncode, stdout, stderr = self.run_ssh_command(node_info, join_command, timeout=600)
         
         if returncode != 0:
-            print(f"Failed to join control plane node {node_info['hostname']}: {stderr}")
+            self._log(f"Failed to join control plane node {node_info['hostname']}: {stderr}")
             return False
         
-        print(f"Successfully joined control plane node: {node_info['hostname']}")
+        self._log(f"Successfully joined control plane node: {node_info['hostname']}")
         return True
     
-    def verify_node_joined(self, node_info: Dict[str, Any]) -> bool:
-        """Verify that the node has successfully joined the cluster"""
-        print(f"Verifying node {node_info['hostname']} has joined...")
-        
-        # Check if node appears in kubectl get nodes
-        cmd = f"kubectl get nodes | grep {node_info['hostname']}"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
-        
-        if returncode != 0:
-            print(f"Node {node_info['hostname']} not found in cluster")
-            return False
-        
-        # Check if node is Ready
-        cmd = f"kubectl get nodes {node_info['hostname']} -o jsonpath='{{.status.conditions[?(@.type==\"Ready\")].status}}'"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
-        
-        if returncode != 0 or stdout.strip() != "True":
-            print(f"Node {node_info['hostname']} is not Ready")
-            return False
+    def verify_node_joined(self, node_info: Dict[str, Any], timeout: int = 300,
+                           shared: bool = False) -> bool:
+        """Wait until the node has joined the cluster and reports Ready
+        
+        A single node waits with a server-side `kubectl wait`; nodes added in
+        a batch (shared=True) poll one node list shared between threads
+        instead of holding a watch each.
+        """
+        self._log(f"Verifying node {node_info['hostname']} has joined...")
+        
+        if not shared:
+            returncode, stdout, stderr = self.run_kubectl(
+                ['wait', '--for=condition=Ready', f"node/{node_info['hostname']}", f'--timeout={timeout}s'],
+                timeout=timeout + 30
+            )
+            if returncode != 0:
+                self._log(f"Node {node_info['hostname']} is not Ready: {stderr}")
+                return False
+            
+            self._log(f"Node {node_info['hostname']} successfully joined and is Ready")
+            return True
+        
+        deadline = time.monotonic() + timeout
+        while True:
+            nodes = self._get_cluster_nodes()
+            node = nodes.get(node_info['hostname']) if nodes else None
+            if node:
+                conditions = node.get('status', {}).get('conditions', [])
+                if any(c.get('type') == 'Ready' and c.get('status') == 'True' for c in conditions):
+                    self._log(f"Node {node_info['hostname']} successfully joined and is Ready")
+                    return True
+            
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(self.NODE_POLL_INTERVAL)
         
-        print(f"Node {node_info['hostname']} successfully joined and is Ready")
-        return True
+        if node:
+            self._log(f"Node {node_info['hostname']} is not Ready")
+        else:
+            self._log(f"Node {node_info['hostname']} not found in cluster")
+        return False
     
-    def add_node(self, node_info: Dict[str, Any], node_type: str = 'worker') -> bool:
+    def add_node(self, node_info: Dict[str, Any], node_type: str = 'worker',
+                 join_command: str = None, batch: bool = False) -> bool:
         """Add a single node to the cluster"""
-        print(f"Adding {node_type} node: {node_info['hostname']}")
+        self._log(f"Adding {node_type} node: {node_info['hostname']}")
         
         # Prepare the node
         if not self.prepare_new_node(node_info):
             return False
         
-        # Get appropriate join command
-        if node_type == 'control-plane':
-            join_command = self.get_control_plane_join_command()
-        else:
-            join_command = self.get_join_token()
+        # Get appropriate join command unless the caller already has one
+        if not join_command:
+            if node_type == 'control-plane':
+                join_command = self.get_control_plane_join_command()
+            else:
+                join_command = self.get_join_token()
         
         if not join_command:
             return False
@@ -204,15 +205,12 @@ class NodeAdder:
         if not success:
             return False
         
-        # Wait a bit for node to register
-        time.sleep(30)
-        
-        # Verify the node joined
-        return self.verify_node_joined(node_info)
+        # Wait for the node to register and become Ready
+        return self.verify_node_joined(node_info, shared=batch)
     
     def add_nodes_from_inventory(self, new_nodes: List[Dict[str, Any]], node_type: str = 'worker') -> bool:
         """Add multiple nodes from inventory"""
-        print(f"Adding {len(new_nodes)} {node_type} nodes...")
+        self._log(f"Adding {len(new_nodes)} {node_type} nodes...")
         
         # Get join command once
         if node_type == 'control-plane':
@@ -223,14 +221,41 @@ class NodeAdder:
         if not join_command:
             return False
         
-        success_count = 0
-        for node_info in new_nodes:
-            if self.add_node(node_info, node_type):
-                success_count += 1
-            else:
-                print(f"Failed to add node: {node_info['hostname']}")
+        # Control plane joins add etcd members and must not race each other
+        max_workers = 1 if node_type == 'control-plane' else min(len(new_nodes), 16)
         
-        print(f"Successfully added {success_count}/{len(new_nodes)} nodes")
+        success_count = 0
+        failed_count = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            future_to_node = {
+                executor.submit(self.add_node, node_info, node_type, join_command, True): node_info
+                for node_info in new_nodes
+            }
+            
+            for future in concurrent.futures.as_completed(future_to_node):
+                node_info = future_to_node[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    self._log(f"Exception adding node {node_info['hostname']}: {e}")
+                    success = False
+                
+                if success:
+                    success_count += 1
+                else:
+                    failed_count += 1
+                    self._log(f"Failed to add node: {node_info['hostname']}")
+                
+                done_count = success_count + failed_count
+                if (done_count >= self.ABORT_MIN_COMPLETED
+                        and failed_count / done_count > self.ABORT_FAILURE_RATIO):
+                    self._log(f"Aborting: {failed_count}/{done_count} nodes failed, "
+                              f"cancelling the remaining {len(new_nodes) - done_count}")
+                    # Nodes already being joined are left to finish
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    return False
+        
+        self._log(f"Successfully added {success_count}/{len(new_nodes)} nodes")
         return success_count == len(new_nodes)
 
 
@@ -253,12 +278,8 @@ def main():
         
         if args.hostname or args.ip:
             # Add specific node
-            target_node = None
-            for node in adder.nodes:
-                if (args.hostname and node['hostname'] == args.hostname) or \
-                   (args.ip and node['ip_address'] == args.ip):
-                    target_node = node
-                    break
+            target_node = (args.hostname and adder._by_host.get(args.hostname)) or \
+                          (args.ip and adder._by_ip.get(args.ip))
             
             if not target_node:
                 print(f"Node not found in inventory: {args.hostname or args.ip}")
@@ -5,217 +5,276 @@ Safely removes a node from an existing Kubernetes cluster
 """
 
 import argparse
-import subprocess
+import concurrent.futures
 import sys
+import threading
 import time
 import yaml
 from pathlib import Path
 from typing import Dict, Any, List
 import json
 
-from inventory_parser import InventoryParser
+from inventory_parser import load_inventory
+from ssh_runner import SSHRunnerMixin
 
 
-class NodeRemover:
+class NodeRemover(SSHRunnerMixin):
     """Class for removing nodes from Kubernetes cluster"""
     
+    # Nodes removed concurrently by remove_nodes, and how many of them may
+    # drain at once (drains are the heavy part for the API server)
+    MAX_PARALLEL_REMOVALS = 8
+    DRAIN_CONCURRENCY = 1
+    
+    # Upper bound for kubectl drain itself; the process timeout adds headroom
+    DRAIN_TIMEOUT = 300
+    
     def __init__(self, inventory_file: str, master_node: str):
         self.inventory_file = inventory_file
         self.master_node = master_node
-        self.inventory = InventoryParser(inventory_file)
-        self.nodes = self.inventory.get_all_nodes()
+        # Parsed once per process; a rolling replace builds both a remover
+        # and an adder from the same inventory
+        self.inventory, self.nodes = load_inventory(inventory_file)
+        
+        # Index nodes by hostname and IP; the first entry wins on duplicates
+        self._by_host = {node['hostname']: node for node in reversed(self.nodes)}
+        self._by_ip = {node['ip_address']: node for node in reversed(self.nodes)}
         
         # Find master node info
-        self.master_info = None
-        for node in self.nodes:
-            if node['hostname'] == master_node or node['ip_address'] == master_node:
-                self.master_info = node
-                break
+        self.master_info = self.find_node(master_node)
         
         if not self.master_info:
             raise ValueError(f"Master node not found: {master_node}")
-    
-    def run_ssh_command(self, host: Dict[str, Any], command: str, timeout: int = 300) -> tuple:
-        """Run SSH command on remote host"""
-        ssh_cmd = [
-            'ssh', '-o', 'StrictHostKeyChecking=no',
-            '-o', 'UserKnownHostsFile=/dev/null',
-            '-o', 'ConnectTimeout=10',
-            '-p', str(host['ssh_port']),
-            f"{host['username']}@{host['ip_address']}",
-            command
-        ]
         
-        try:
-            result = subprocess.run(
-                ssh_cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=timeout
-            )
-            return result.returncode, result.stdout, result.stderr
-        except subprocess.TimeoutExpired:
-            return -1, "", "Command timed out"
-        except Exception as e:
-            return -1, "", str(e)
+        # SSH multiplexing, local fast path, kubectl and node list cache
+        self._init_runner()
+        
+        # Only DRAIN_CONCURRENCY drains run at once
+        self._drain_slots = threading.Semaphore(self.DRAIN_CONCURRENCY)
+    
+    def find_node(self, node_identifier: str) -> Dict[str, Any]:
+        """Find an inventory node by hostname or IP address"""
+        return self._by_host.get(node_identifier) or self._by_ip.get(node_identifier)
     
     def get_node_info(self, node_identifier: str) -> Dict[str, Any]:
         """Get node information from cluster"""
-        print(f"Getting information for node: {node_identifier}")
+        self._log(f"Getting information for node: {node_identifier}")
         
         # Try to get node info from kubectl
-        cmd = f"kubectl get nodes {node_identifier} -o json"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
+        returncode, stdout, stderr = self.run_kubectl(['get', 'nodes', node_identifier, '-o', 'json'])
         
         if returncode != 0:
-            print(f"Node {node_identifier} not found in cluster: {stderr}")
+            self._log(f"Node {node_identifier} not found in cluster: {stderr}")
             return None
         
         try:
             node_info = json.loads(stdout)
             return node_info
         except json.JSONDecodeError:
-            print(f"Failed to parse node information: {stdout}")
+            self._log(f"Failed to parse node information: {stdout}")
             return None
     
     def drain_node(self, node_identifier: str, force: bool = False) -> bool:
         """Drain pods from the node"""
-        print(f"Draining node: {node_identifier}")
+        self._log(f"Draining node: {node_identifier}")
         
-        # Check if node exists
-        node_info = self.get_node_info(node_identifier)
-        if not node_info:
+        # Only check existence when a node list is already cached; kubectl
+        # drain fails on unknown nodes by itself
+        cached = self._get_cluster_nodes(refresh=False)
+        if cached is not None and node_identifier not in cached:
+            self._log(f"Node {node_identifier} not found in cluster")
             return False
         
         # Build drain command
-        drain_cmd = f"kubectl drain {node_identifier}"
-        
-        # Add options based on node type
-        if node_info.get('spec', {}).get('unschedulable') is None:
-            drain_cmd += " --ignore-daemonsets"
+        drain_args = ['drain', node_identifier, '--ignore-daemonsets']
         
         if force:
-            drain_cmd += " --force --grace-period=0"
-        
-        drain_cmd += " --delete-emptydir-data"
+            drain_args += ['--force', '--grace-period=0']
+        
+        # Bound the drain instead of letting a stuck eviction hang forever, and
+        # don't wait on pods that were deleted long ago but linger terminating
+        drain_args += [
+            '--delete-emptydir-data',
+            f'--timeout={self.DRAIN_TIMEOUT}s',
+            '--skip-wait-for-delete-timeout=10'
+        ]
         
-        print(f"Running drain command: {drain_cmd}")
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, drain_cmd, timeout=600)
+        self._log(f"Running drain command: kubectl {' '.join(drain_args)}")
+        with self._drain_slots:
+            returncode, stdout, stderr = self.run_kubectl(drain_args, timeout=self.DRAIN_TIMEOUT + 60, stream=True)
         
         if returncode != 0:
-            print(f"Failed to drain node {node_identifier}: {stderr}")
+            self._log(f"Failed to drain node {node_identifier}: {stderr}")
             if not force:
-                print("Use --force to force drain even if there are errors")
+                self._log("Use --force to force drain even if there are errors")
             return False
         
-        print(f"Successfully drained node: {node_identifier}")
+        self._log(f"Successfully drained node: {node_identifier}")
         return True
     
     def delete_node(self, node_identifier: str) -> bool:
         """Delete node from cluster"""
-        print(f"Deleting node from cluster: {node_identifier}")
+        self._log(f"Deleting node from cluster: {node_identifier}")
         
-        cmd = f"kubectl delete node {node_identifier}"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
+        returncode, stdout, stderr = self.run_kubectl(['delete', 'node', node_identifier])
         
         if returncode != 0:
-            print(f"Failed to delete node {node_identifier}: {stderr}")
+            self._log(f"Failed to delete node {node_identifier}: {stderr}")
             return False
         
-        print(f"Successfully deleted node from cluster: {node_identifier}")
+        self._log(f"Successfully deleted node from cluster: {node_identifier}")
         return True
     
     def reset_node(self, node_info: Dict[str, Any]) -> bool:
         """Reset node (remove Kubernetes components)"""
-        print(f"Resetting node: {node_info['hostname']}")
-        
-        # Run kubeadm reset
-        reset_cmd = "kubeadm reset --force"
+        self._log(f"Resetting node: {node_info['hostname']}")
+        
+        # Reset and clean up in one SSH session. A failed kubeadm reset aborts;
+        # the cleanup steps all run, but any that fail make the script exit 2
+        # so the failure is reported instead of silently ignored.
+        # Flush through iptables rather than `nft flush ruleset`: the latter
+        # would also drop firewalld's own nftables table (prepare_node.sh
+        # enables firewalld on RHEL-family nodes), and on iptables-legacy
+        # hosts it succeeds without touching the legacy rules at all.
+        reset_cmd = "; ".join([
+            "kubeadm reset --force || exit 1",
+            "rc=0",
+            "{ iptables -F && iptables -t nat -F && iptables -t mangle -F && iptables -X; } "
+            "|| { echo 'failed to flush iptables rules' >&2; rc=2; }",
+            "for link in cni0 flannel.1; do "
+            "if ip link show \"$link\" >/dev/null 2>&1; then "
+            "ip link delete \"$link\" || { echo \"failed to delete $link\" >&2; rc=2; }; fi; done",
+            "rm -rf /var/lib/cni /var/lib/kubelet /etc/cni /etc/kubernetes "
+            "|| { echo 'failed to remove Kubernetes state directories' >&2; rc=2; }",
+            "exit $rc"
+        ])
         returncode, stdout, stderr = self.run_ssh_command(node_info, reset_cmd, timeout=300)
         
-        if returncode != 0:
-            print(f"Failed to reset node {node_info['hostname']}: {stderr}")
+        if returncode == 2:
+            self._log(f"Node {node_info['hostname']} was reset but cleanup failed: {stderr}")
             return False
         
-        # Clean up iptables rules
-        cleanup_cmd = "iptables -F && iptables -t nat -F && iptables -t mangle -F && iptables -X"
-        returncode, stdout, stderr = self.run_ssh_command(node_info, cleanup_cmd)
-        
-        # Clean up network interfaces
-        network_cmd = "ip link delete cni0 2>/dev/null || true && ip link delete flannel.1 2>/dev/null || true"
-        returncode, stdout, stderr = self.run_ssh_command(node_info, network_cmd)
-        
-        # Clean up directories
-        cleanup_dirs_cmd = "rm -rf /var/lib/cni /var/lib/kubelet /etc/cni /etc/kubernetes"
-        returncode, stdout, stderr = self.run_ssh_command(node_info, cleanup_dirs_cmd)
+        if returncode != 0:
+            self._log(f"Failed to reset node {node_info['hostname']}: {stderr}")
+            return False
         
-        print(f"Successfully reset node: {node_info['hostname']}")
+        self._log(f"Successfully reset node: {node_info['hostname']}")
         return True
     
     def remove_node(self, node_identifier: str, force: bool = False, reset: bool = True) -> bool:
         """Remove a node from the cluster"""
-        print(f"Removing node: {node_identifier}")
+        self._log(f"Removing node: {node_identifier}")
         
         # Get node info from inventory
-        node_info = None
-        for node in self.nodes:
-            if node['hostname'] == node_identifier or node['ip_address'] == node_identifier:
-                node_info = node
-                break
+        node_info = self.find_node(node_identifier)
         
         if not node_info:
-            print(f"Node {node_identifier} not found in inventory")
+            self._log(f"Node {node_identifier} not found in inventory")
             return False
         
+        # Cluster nodes are named after the inventory hostname, so an IP is
+        # resolved once here and every kubectl step uses the name
+        node_name = node_info['hostname']
+        
         # Step 1: Drain the node
-        if not self.drain_node(node_identifier, force):
+        if not self.drain_node(node_name, force):
             if not force:
-                print("Drain failed. Use --force to continue anyway.")
+                self._log(f"Drain of {node_name} failed. Use --force to continue anyway.")
                 return False
         
         # Step 2: Delete node from cluster
-        if not self.delete_node(node_identifier):
+        if not self.delete_node(node_name):
             return False
         
         # Step 3: Reset node (optional)
         if reset:
             if not self.reset_node(node_info):
-                print(f"Warning: Failed to reset node {node_info['hostname']}")
+                self._log(f"Warning: Failed to reset node {node_name}")
         
-        print(f"Successfully removed node: {node_identifier}")
+        self._log(f"Successfully removed node: {node_name}")
         return True
     
+    def remove_nodes(self, node_identifiers: List[str], force: bool = False, reset: bool = True) -> bool:
+        """Remove several nodes, overlapping one node's reset with the next one's drain"""
+        self._log(f"Removing {len(node_identifiers)} nodes...")
+        
+        max_workers = max(1, min(len(node_identifiers), self.MAX_PARALLEL_REMOVALS))
+        success_count = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_node = {
+                executor.submit(self.remove_node, node_identifier, force, reset): node_identifier
+                for node_identifier in node_identifiers
+            }
+            
+            for future in concurrent.futures.as_completed(future_to_node):
+                node_identifier = future_to_node[future]
+                try:
+                    success = future.result()
+                except Exception as e:
+                    self._log(f"Exception removing node {node_identifier}: {e}")
+                    success = False
+                
+                if success:
+                    success_count += 1
+                else:
+                    self._log(f"Failed to remove node: {node_identifier}")
+        
+        self._log(f"Successfully removed {success_count}/{len(node_identifiers)} nodes")
+        return success_count == len(node_identifiers)
+    
     def list_nodes(self) -> List[str]:
         """List all nodes in the cluster"""
-        print("Listing cluster nodes...")
+        self._log("Listing cluster nodes...")
         
-        cmd = "kubectl get nodes -o jsonpath='{.items[*].metadata.name}'"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
-        
-        if returncode != 0:
-            print(f"Failed to list nodes: {stderr}")
+        # Fills the node cache that drain_node checks against
+        cluster_nodes = self._get_cluster_nodes()
+        if cluster_nodes is None:
             return []
         
-        nodes = stdout.strip().split()
-        print(f"Found {len(nodes)} nodes in cluster:")
+        nodes = list(cluster_nodes)
+        
+        self._log(f"Found {len(nodes)} nodes in cluster:")
         for node in nodes:
-            print(f"  - {node}")
+            self._log(f"  - {node}")
         
         return nodes
     
     def get_node_status(self, node_identifier: str) -> Dict[str, Any]:
-        """Get detailed status of a node"""
-        print(f"Getting status for node: {node_identifier}")
+        """Get the node object from the cluster as a dict"""
+        self._log(f"Getting status for node: {node_identifier}")
         
-        cmd = f"kubectl describe node {node_identifier}"
-        returncode, stdout, stderr = self.run_ssh_command(self.master_info, cmd)
+        returncode, stdout, stderr = self.run_kubectl(['get', 'node', node_identifier, '-o', 'json'])
         
         if returncode != 0:
-            print(f"Failed to get node status: {stderr}")
+            self._log(f"Failed to get node status: {stderr}")
+            return None
+        
+        try:
+            return json.loads(stdout)
+        except json.JSONDecodeError:
+            self._log(f"Failed to parse node status: {stdout}")
             return None
+    
+    def print_node_status(self, node: Dict[str, Any]):
+        """Print a short summary of a node object returned by get_node_status"""
+        metadata = node.get('metadata', {})
+        status = node.get('status', {})
+        
+        roles = sorted(
+            label.split('/', 1)[1]
+            for label in metadata.get('labels', {})
+            if label.startswith('node-role.kubernetes.io/')
+        )
         
-        print(stdout)
-        return {'output': stdout}
+        self._log(f"Name: {metadata.get('name', '')}")
+        self._log(f"Roles: {', '.join(roles) or '<none>'}")
+        self._log(f"Kubelet version: {status.get('nodeInfo', {}).get('kubeletVersion', '')}")
+        self._log("Conditions:")
+        for condition in status.get('conditions', []):
+            self._log(f"  {condition.get('type')}: {condition.get('status')}")
+        self._log("Capacity:")
+        for resource, quantity in status.get('capacity', {}).items():
+            self._log(f"  {resource}: {quantity}")
 
 
 def main():
@@ -223,7 +282,8 @@ def main():
     parser = argparse.ArgumentParser(description='Remove node(s) from Kubernetes cluster')
     parser.add_argument('inventory_file', help='Path to inventory file')
     parser.add_argument('master_node', help='Master node hostname or IP')
-    parser.add_argument('--node', help='Node hostname or IP to remove')
+    parser.add_argument('--node', action='append',
+                       help='Node hostname or IP to remove (repeat to remove several)')
     parser.add_argument('--force', action='store_true',
                        help='Force removal even if drain fails')
     parser.add_argument('--no-reset', action='store_true',
@@ -242,18 +302,28 @@ def main():
             return
         
         if args.status:
-            remover.get_node_status(args.status)
+            node = remover.get_node_status(args.status)
+            if node is None:
+                sys.exit(1)
+            remover.print_node_status(node)
             return
         
         if not args.node:
             print("Please specify --node to remove, or use --list to see available nodes")
             sys.exit(1)
         
-        success = remover.remove_node(
-            args.node, 
-            force=args.force, 
-            reset=not args.no_reset
-        )
+        if len(args.node) == 1:
+            success = remover.remove_node(
+                args.node[0], 
+                force=args.force, 
+                reset=not args.no_reset
+            )
+        else:
+            success = remover.remove_nodes(
+                args.node,
+                force=args.force,
+                reset=not args.no_reset
+            )
         
         sys.exit(0 if success else 1)
     
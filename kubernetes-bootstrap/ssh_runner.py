@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+SSH and kubectl Command Runner
+Shared by the cluster bootstrap and the node add/remove scripts
+"""
+
+import atexit
+import getpass
+import hashlib
+import json
+import os
+import random
+import selectors
+import shlex
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import List, Dict, Any
+
+
+class SSHRunnerMixin:
+    """Run commands on inventory nodes over multiplexed SSH, and kubectl on the master
+    
+    Classes using it set self.nodes (and self.master_info for kubectl) and
+    call _init_runner() from __init__.
+    """
+    
+    def _init_runner(self):
+        """Set up the SSH control directory, client binaries and caches"""
+        # Keeps log lines from parallel work from interleaving
+        self._print_lock = threading.Lock()
+        
+        # Per-process directory for SSH ControlMaster sockets
+        self._ctl_dir = tempfile.mkdtemp(prefix='odp-ssh-')
+        atexit.register(self.close_master)
+        
+        # Resolve client binaries once instead of searching PATH on every exec
+        self._ssh = shutil.which('ssh') or 'ssh'
+        self._scp = shutil.which('scp') or 'scp'
+        self._rsync = shutil.which('rsync')
+        
+        # Nodes that are this machine skip SSH entirely
+        self._local_addresses = self._get_local_addresses()
+        self._user = getpass.getuser()
+        
+        # ssh/scp argv prefixes per target, see _ssh_prefix
+        self._argv_prefixes = {}
+        
+        # Admin kubeconfig copied from the master on first kubectl use
+        self._kubeconfig = None
+        self._kubeconfig_lock = threading.Lock()
+        
+        # Short-lived cache of `kubectl get nodes -o json`
+        self._nodes_cache = (None, 0.0)
+        self._nodes_lock = threading.Lock()
+    
+    def _log(self, message: str):
+        """Print a message without interleaving with other threads"""
+        with self._print_lock:
+            print(message)
+    
+    @staticmethod
+    def _get_local_addresses() -> set:
+        """Names and addresses that refer to this machine"""
+        addresses = {'127.0.0.1', '::1', 'localhost', socket.gethostname(), socket.getfqdn()}
+        try:
+            addresses.update(socket.gethostbyname_ex(socket.gethostname())[2])
+        except OSError:
+            pass
+        return addresses
+    
+    def _is_local(self, host: Dict[str, Any]) -> bool:
+        """Check whether a node is this machine, reached as the current user"""
+        return (
+            (host['ip_address'] in self._local_addresses or host['hostname'] in self._local_addresses)
+            and host['username'] == self._user
+        )
+    
+    def _control_path(self, host: Dict[str, Any]) -> str:
+        """Get the ControlMaster socket path for a host"""
+        # Hash the target so the socket path stays below the 108 char limit
+        target = f"{host['username']}@{host['ip_address']}:{host['ssh_port']}"
+        digest = hashlib.blake2b(target.encode(), digest_size=8).hexdigest()
+        return os.path.join(self._ctl_dir, digest)
+    
+    def _extra_ssh_options(self, host: Dict[str, Any]) -> List[str]:
+        """Additional ssh/scp options, for subclasses to override"""
+        return []
+    
+    def _ssh_options(self, host: Dict[str, Any]) -> List[str]:
+        """Common ssh/scp options, reusing one multiplexed connection per host"""
+        return [
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'ControlMaster=auto',
+            '-o', f"ControlPath={self._control_path(host)}",
+            '-o', 'ControlPersist=10m',
+            '-o', 'ServerAliveInterval=30',
+            *self._extra_ssh_options(host),
+        ]
+    
+    def _ssh_prefix(self, host: Dict[str, Any]) -> tuple:
+        """ssh argv up to the remote command, built once per host"""
+        key = ('ssh', host['username'], host['ip_address'], host['ssh_port'])
+        prefix = self._argv_prefixes.get(key)
+        if prefix is None:
+            prefix = self._argv_prefixes[key] = (
+                self._ssh, *self._ssh_options(host),
+                '-o', 'ConnectTimeout=10',
+                '-p', str(host['ssh_port']),
+                f"{host['username']}@{host['ip_address']}"
+            )
+        return prefix
+    
+    def _scp_prefix(self, host: Dict[str, Any]) -> tuple:
+        """scp argv up to the source and destination, built once per host"""
+        key = ('scp', host['username'], host['ip_address'], host['ssh_port'])
+        prefix = self._argv_prefixes.get(key)
+        if prefix is None:
+            prefix = self._argv_prefixes[key] = (
+                self._scp, *self._ssh_options(host),
+                '-P', str(host['ssh_port'])
+            )
+        return prefix
+    
+    def close_master(self):
+        """Close SSH master connections and remove the control socket directory"""
+        for host in self.nodes:
+            if not os.path.exists(self._control_path(host)):
+                continue
+            
+            exit_cmd = [
+                self._ssh, '-O', 'exit',
+                '-o', f"ControlPath={self._control_path(host)}",
+                '-p', str(host['ssh_port']),
+                f"{host['username']}@{host['ip_address']}"
+            ]
+            try:
+                subprocess.run(exit_cmd, capture_output=True, text=True, timeout=10)
+            except Exception as e:
+                self._log(f"Error closing SSH connection to {host['hostname']}: {e}")
+        
+        shutil.rmtree(self._ctl_dir, ignore_errors=True)
+    
+    def _run_process(self, cmd: List[str], timeout: int, stream: bool = False,
+                     label: str = None, stdin: str = None) -> tuple:
+        """Run a command, draining its output incrementally instead of buffering it all"""
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception as e:
+            return -1, "", str(e)
+        
+        chunks = {proc.stdout: [], proc.stderr: []}
+        pending = b''
+        deadline = time.monotonic() + timeout
+        
+        with selectors.DefaultSelector() as selector:
+            for pipe in chunks:
+                selector.register(pipe, selectors.EVENT_READ)
+            
+            # Feed stdin alongside reading so neither side blocks on a full pipe
+            if stdin is not None:
+                to_send = memoryview(stdin.encode())
+                os.set_blocking(proc.stdin.fileno(), False)
+                selector.register(proc.stdin, selectors.EVENT_WRITE)
+            
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    proc.terminate()
+                    try:
+                        proc.wait(timeout=5)
+                    except subprocess.TimeoutExpired:
+                        proc.kill()
+                        proc.wait()
+                    for pipe in (proc.stdin, proc.stdout, proc.stderr):
+                        if pipe:
+                            pipe.close()
+                    return -1, "", "Command timed out"
+                
+                # Once the process is gone, a pipe may still be held open by a
+                # backgrounded ControlMaster; take what is there and stop
+                exited = proc.poll() is not None
+                events = selector.select(timeout=0 if exited else min(remaining, 1.0))
+                if exited and not events:
+                    break
+                
+                for key, _ in events:
+                    if key.fileobj is proc.stdin:
+                        try:
+                            to_send = to_send[os.write(key.fd, to_send[:65536]):]
+                        except BrokenPipeError:
+                            to_send = to_send[:0]
+                        if not to_send:
+                            selector.unregister(proc.stdin)
+                            proc.stdin.close()
+                        continue
+                    
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    chunks[key.fileobj].append(data)
+                    
+                    if stream and key.fileobj is proc.stdout:
+                        *lines, pending = (pending + data).split(b'\n')
+                        for line in lines:
+                            self._log(f"[{label}] {line.decode(errors='replace')}")
+        
+        if stream and pending:
+            self._log(f"[{label}] {pending.decode(errors='replace')}")
+        
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            if pipe:
+                pipe.close()
+        returncode = proc.wait()
+        stdout = b''.join(chunks[proc.stdout]).decode(errors='replace')
+        stderr = b''.join(chunks[proc.stderr]).decode(errors='replace')
+        return returncode, stdout, stderr
+    
+    def run_ssh_command(self, host: Dict[str, Any], command: str, timeout: int = 300,
+                        retries: int = 3, stream: bool = False, stdin: str = None) -> tuple:
+        """Run SSH command on remote host with optional stdin, retrying connection failures"""
+        if self._is_local(host):
+            # Running on the node itself, no need to go through sshd. Never
+            # retry here: 255 would be the command's own exit status.
+            return self._run_process(['/bin/bash', '-c', command], timeout, stream,
+                                     label=host['hostname'], stdin=stdin)
+        
+        ssh_cmd = [*self._ssh_prefix(host), command]
+        for attempt in range(retries):
+            returncode, stdout, stderr = self._run_process(ssh_cmd, timeout, stream,
+                                                           label=host['hostname'], stdin=stdin)
+            # ssh exits with 255 when the connection itself failed
+            if returncode != 255 or attempt == retries - 1:
+                break
+            time.sleep(2 ** attempt + random.uniform(0, 1))
+        
+        return returncode, stdout, stderr
+    
+    def copy_file_to_host(self, host: Dict[str, Any], local_file: str, remote_path: str) -> bool:
+        """Copy file to remote host using rsync, falling back to scp"""
+        if self._is_local(host):
+            try:
+                shutil.copy(local_file, remote_path)
+                return True
+            except Exception as e:
+                self._log(f"Error copying file to {host['hostname']}: {e}")
+                return False
+        
+        destination = f"{host['username']}@{host['ip_address']}:{remote_path}"
+        
+        if self._rsync:
+            # Ride the multiplexed connection and skip unchanged files on re-runs
+            ssh_cmd = shlex.join([self._ssh, '-T', *self._ssh_options(host), '-p', str(host['ssh_port'])])
+            rsync_cmd = [self._rsync, '-az', '--partial', '-e', ssh_cmd, local_file, destination]
+            
+            try:
+                result = subprocess.run(rsync_cmd, capture_output=True, text=True)
+                if result.returncode == 0:
+                    return True
+            except Exception as e:
+                self._log(f"Error copying file to {host['hostname']} with rsync: {e}")
+        
+        # rsync may be missing locally or on a freshly installed node
+        scp_cmd = [*self._scp_prefix(host), local_file, destination]
+        
+        try:
+            result = subprocess.run(scp_cmd, capture_output=True, text=True)
+            return result.returncode == 0
+        except Exception as e:
+            self._log(f"Error copying file to {host['hostname']}: {e}")
+            return False
+    
+    def _fetch_kubeconfig(self) -> str:
+        """Copy the master's admin kubeconfig to a private local file"""
+        returncode, stdout, stderr = self.run_ssh_command(self.master_info, "cat /etc/kubernetes/admin.conf")
+        if returncode != 0:
+            self._log(f"Failed to fetch kubeconfig, running kubectl over SSH: {stderr}")
+            return None
+        
+        # Lives in the private control directory, removed again at exit
+        kubeconfig = os.path.join(self._ctl_dir, 'admin.conf')
+        with os.fdopen(os.open(kubeconfig, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(stdout)
+        
+        # The server address in admin.conf may be filtered or an internal
+        # name from here; check it once so kubectl can fall back to SSH
+        returncode, stdout, stderr = self._run_process(
+            ['kubectl', '--kubeconfig', kubeconfig, 'get', '--raw=/readyz', '--request-timeout=5s'],
+            timeout=15
+        )
+        if returncode != 0:
+            self._log(f"API server not reachable from here, running kubectl over SSH: {stderr.strip()}")
+            os.remove(kubeconfig)
+            return None
+        
+        return kubeconfig
+    
+    def run_kubectl(self, args: List[str], timeout: int = 300, stream: bool = False) -> tuple:
+        """Run kubectl against the cluster, locally when possible"""
+        with self._kubeconfig_lock:
+            if self._kubeconfig is None:
+                # Only worth fetching when kubectl is installed here
+                self._kubeconfig = (shutil.which('kubectl') and self._fetch_kubeconfig()) or ''
+        
+        if not self._kubeconfig:
+            return self.run_ssh_command(self.master_info, f"kubectl {shlex.join(args)}",
+                                        timeout=timeout, stream=stream)
+        
+        return self._run_process(['kubectl', '--kubeconfig', self._kubeconfig, *args],
+                                 timeout, stream, label='kubectl')
+    
+    def _get_cluster_nodes(self, max_age: float = 5.0, refresh: bool = True) -> Dict[str, Dict[str, Any]]:
+        """Get cluster nodes by name, reusing a node list fetched within max_age seconds
+        
+        Failed fetches are remembered for max_age too (as None), so threads
+        polling an unreachable API neither retry nor log in lockstep.
+        """
+        with self._nodes_lock:
+            nodes, fetched_at = self._nodes_cache
+            if fetched_at and time.monotonic() - fetched_at < max_age:
+                return nodes
+            if not refresh:
+                return None
+            
+            returncode, stdout, stderr = self.run_kubectl(['get', 'nodes', '-o', 'json'])
+            if returncode != 0:
+                self._log(f"Failed to list cluster nodes: {stderr}")
+                self._nodes_cache = (None, time.monotonic())
+                return None
+            
+            try:
+                items = json.loads(stdout).get('items', [])
+            except json.JSONDecodeError:
+                self._log(f"Failed to parse cluster nodes: {stdout}")
+                self._nodes_cache = (None, time.monotonic())
+                return None
+            
+            nodes = {item['metadata']['name']: item for item in items}
+            self._nodes_cache = (nodes, time.monotonic())
+            return nodes